@@ -1,11 +1,55 @@
 import sqlite3
+import threading
 import numpy as np
 import logging
-from datetime import datetime, date # Import datetime dan date untuk penanganan waktu
-from typing import List, Dict, Any
+from datetime import date # Import date untuk penanganan waktu
+from typing import List, Dict, Tuple, Optional
 
 logging.basicConfig(level=logging.INFO)
 
+EMBEDDING_DIM = 512 # Dimensi embedding FaceNet (InceptionResnetV1)
+
+# --- KONEKSI DATABASE (PERSISTEN) ---
+
+# Satu koneksi per file database, dipakai ulang oleh semua fungsi di modul ini
+_CONN_CACHE: Dict[str, sqlite3.Connection] = {}
+_CONN_LOCK = threading.Lock()
+# FastAPI dapat memanggil fungsi penulis dari threadpool, jadi penulisan diserialisasi
+_WRITE_LOCK = threading.Lock()
+
+def _get_conn(db_name: str) -> sqlite3.Connection:
+    """
+    Mengembalikan koneksi SQLite yang di-cache untuk db_name (dibuat saat pertama kali dipakai).
+    Koneksi memakai WAL mode agar pembaca tidak terblokir oleh penulis.
+    """
+    conn = _CONN_CACHE.get(db_name)
+    if conn is not None:
+        return conn
+
+    with _CONN_LOCK:
+        conn = _CONN_CACHE.get(db_name)
+        if conn is None:
+            conn = sqlite3.connect(db_name, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.execute("PRAGMA temp_store=MEMORY")
+            _CONN_CACHE[db_name] = conn
+    return conn
+
+def _normalize_embedding(embedding_array: np.ndarray) -> np.ndarray:
+    """Normalisasi (L2) embedding menjadi vektor float32 1 dimensi."""
+    e = embedding_array.astype(np.float32).ravel()
+    n = np.sqrt(np.vdot(e, e))
+    if n > 0:
+        e = e / n
+    return e
+
+def _embedding_to_blob(embedding_array: np.ndarray) -> bytes:
+    """Normalisasi (L2) embedding lalu konversi ke byte (BLOB float32)."""
+    # Normalisasi sekali saat disimpan agar Server cukup menghitung dot product
+    return _normalize_embedding(embedding_array).tobytes()
+
 # --- FUNGSI UTAMA DATABASE ---
 
 def create_initial_tables(db_name: str):
@@ -13,132 +57,171 @@ def create_initial_tables(db_name: str):
     Membuat tabel 'magang' dan 'absensi' jika belum ada.
     Dipanggil oleh initial_db_setup.py.
     """
-    conn = None
+    conn = _get_conn(db_name)
     try:
-        conn = sqlite3.connect(db_name)
-        cursor = conn.cursor()
+        with _WRITE_LOCK:
+            cursor = conn.cursor()
 
-        # 1. Tabel MAGANG (Master Data Wajah)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS magang (
-                id TEXT PRIMARY KEY,
-                nama TEXT NOT NULL,
-                master_embedding BLOB NOT NULL,
-                last_updated TEXT
-            );
-        """)
-
-        # 2. Tabel ABSENSI (Log Absensi Harian)
-        # Catatan: AUTOINCREMENT dihilangkan karena INTEGER PRIMARY KEY sudah menyediakan fungsi yang sama
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS absensi (
-                id INTEGER PRIMARY KEY,
-                magang_id TEXT NOT NULL,
-                nama TEXT NOT NULL,
-                timestamp TEXT NOT NULL,
-                type TEXT DEFAULT 'MASUK'
-            );
-        """)
-        conn.commit()
+            # 1. Tabel MAGANG (Master Data Wajah)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS magang (
+                    id TEXT PRIMARY KEY,
+                    nama TEXT NOT NULL,
+                    master_embedding BLOB NOT NULL,
+                    last_updated TEXT DEFAULT (datetime('now', 'localtime'))
+                );
+            """)
+
+            # 2. Tabel ABSENSI (Log Absensi Harian)
+            # Catatan: AUTOINCREMENT dihilangkan karena INTEGER PRIMARY KEY sudah menyediakan fungsi yang sama
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS absensi (
+                    id INTEGER PRIMARY KEY,
+                    magang_id TEXT NOT NULL,
+                    nama TEXT NOT NULL,
+                    timestamp TEXT NOT NULL DEFAULT (datetime('now', 'localtime')),
+                    type TEXT DEFAULT 'MASUK'
+                );
+            """)
+
+            # 3. Index pencarian untuk check_already_absen & try_log_absensi (range scan pada timestamp)
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_absensi_lookup
+                ON absensi (magang_id, type, timestamp);
+            """)
+            conn.commit()
         logging.info(f"Tabel 'magang' dan 'absensi' berhasil dibuat atau sudah ada di {db_name}.")
 
     except sqlite3.Error as e:
+        conn.rollback()
         logging.error(f"Error saat membuat tabel: {e}")
-    finally:
-        if conn:
-            conn.close()
 
 def clear_magang_table(db_name: str):
     """Hapus semua data di tabel magang."""
-    conn = None
+    conn = _get_conn(db_name)
     try:
-        conn = sqlite3.connect(db_name)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM magang")
-        # Mereset counter ID (hanya jika ada)
-        try:
-            cursor.execute("DELETE FROM sqlite_sequence WHERE name='magang'")
-        except sqlite3.OperationalError:
-            pass # Lewati jika tabel belum ada
-        conn.commit()
+        with _WRITE_LOCK:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM magang")
+            # Mereset counter ID (hanya jika ada)
+            try:
+                cursor.execute("DELETE FROM sqlite_sequence WHERE name='magang'")
+            except sqlite3.OperationalError:
+                pass # Lewati jika tabel belum ada
+            conn.commit()
         logging.info("Tabel magang berhasil dibersihkan dan counter ID direset.")
     except sqlite3.Error as e:
+        conn.rollback()
         logging.error(f"Gagal membersihkan tabel magang: {e}")
-    finally:
-        if conn:
-            conn.close()
 
 def save_new_magang(db_name: str, magang_id: str, magang_name: str, embedding_array: np.ndarray) -> tuple:
     """
     Menyimpan atau memperbarui data magang (termasuk master embedding) ke database.
     Dipanggil oleh training_embedding.py.
     """
-    conn = None
+    conn = _get_conn(db_name)
     try:
-        conn = sqlite3.connect(db_name)
-        cursor = conn.cursor()
-        
-        # Konversi numpy array (float32) ke byte (BLOB)
-        embedding_blob = embedding_array.astype(np.float32).tobytes()
-        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-        # Menggunakan INSERT OR REPLACE untuk memastikan ID yang sama akan diupdate
-        cursor.execute("""
-            INSERT OR REPLACE INTO magang (id, nama, master_embedding, last_updated)
-            VALUES (?, ?, ?, ?)
-        """, (magang_id, magang_name, embedding_blob, current_time))
+        embedding_blob = _embedding_to_blob(embedding_array)
 
-        conn.commit()
+        with _WRITE_LOCK:
+            # Menggunakan INSERT OR REPLACE untuk memastikan ID yang sama akan diupdate.
+            # last_updated diisi langsung oleh SQLite (waktu lokal).
+            conn.execute("""
+                INSERT OR REPLACE INTO magang (id, nama, master_embedding, last_updated)
+                VALUES (?, ?, ?, datetime('now', 'localtime'))
+            """, (magang_id, magang_name, embedding_blob))
+            conn.commit()
         return True, f"Data Magang '{magang_name}' berhasil disimpan/diperbarui."
 
     except sqlite3.Error as e:
+        conn.rollback()
         return False, f"Gagal menyimpan data magang: {e}"
-    finally:
-        if conn:
-            conn.close()
 
-def load_all_magang_embeddings(db_name: str) -> List[Dict[str, Any]]:
+def save_many_magang(db_name: str, rows: List[tuple]) -> tuple:
+    """
+    Menyimpan banyak data magang sekaligus dalam SATU transaksi (executemany).
+    rows: list of (magang_id, magang_name, embedding_array).
+    Dipanggil oleh training_embedding.py setelah semua embedding selesai dihitung.
+    """
+    conn = _get_conn(db_name)
+    params = [
+        (magang_id, magang_name, _embedding_to_blob(embedding_array))
+        for magang_id, magang_name, embedding_array in rows
+    ]
+
+    try:
+        with _WRITE_LOCK:
+            # Bulk load: fsync dimatikan sementara, dikembalikan setelah commit
+            conn.execute("PRAGMA synchronous=OFF")
+            try:
+                conn.executemany("""
+                    INSERT OR REPLACE INTO magang (id, nama, master_embedding, last_updated)
+                    VALUES (?, ?, ?, datetime('now', 'localtime'))
+                """, params)
+                conn.commit()
+            finally:
+                if conn.in_transaction:
+                    conn.rollback()
+                conn.execute("PRAGMA synchronous=NORMAL")
+        return True, f"{len(params)} data magang berhasil disimpan/diperbarui."
+
+    except sqlite3.Error as e:
+        return False, f"Gagal menyimpan data magang: {e}"
+
+def load_all_magang_embeddings(db_name: str) -> Tuple[np.ndarray, List[str], List[str]]:
     """
     Memuat semua master embedding dari database untuk digunakan oleh Server (FaceNet Recognition).
     Dipanggil saat startup server_main.py.
+    Mengembalikan (matriks float32 (N, 512), list ID, list nama) yang sejajar per baris.
     """
-    conn = None
-    magang_list = []
+    ids, names = [], []
+    matrix = np.empty((0, EMBEDDING_DIM), dtype=np.float32)
     try:
-        conn = sqlite3.connect(db_name)
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, nama, master_embedding FROM magang")
-        
-        for row in cursor.fetchall():
-            magang_id, nama, embedding_blob = row
-            
-            # Konversi BLOB kembali ke numpy array (float32, 512 dimensi)
-            embedding_array = np.frombuffer(embedding_blob, dtype=np.float32)
-            
-            magang_list.append({
-                'id': magang_id,
-                'name': nama,
-                'embedding': embedding_array
-            })
-            
+        conn = _get_conn(db_name)
+        n = conn.execute("SELECT COUNT(*) FROM magang").fetchone()[0]
+
+        # Satu alokasi kontigu; setiap baris diisi langsung dari BLOB
+        matrix = np.empty((n, EMBEDDING_DIM), dtype=np.float32)
+
+        cursor = conn.execute("SELECT id, nama, master_embedding FROM magang ORDER BY id")
+        filled = 0
+        for magang_id, nama, embedding_blob in cursor:
+            if filled >= n:
+                break  # Baris baru ditambahkan setelah COUNT(*); dimuat saat restart berikutnya
+
+            try:
+                # Konversi BLOB kembali ke numpy array (float32, 512 dimensi).
+                # Dinormalisasi ulang untuk data lama yang disimpan sebelum normalisasi saat simpan.
+                matrix[filled] = _normalize_embedding(
+                    np.frombuffer(embedding_blob, dtype=np.float32, count=EMBEDDING_DIM)
+                )
+            except (ValueError, TypeError) as e:
+                # BLOB rusak/terpotong: lewati baris ini agar startup Server tetap berjalan
+                logging.error(f"Embedding magang '{magang_id}' tidak valid, dilewati: {e}")
+                continue
+
+            ids.append(magang_id)
+            names.append(nama)
+            filled += 1
+
+        matrix = matrix[:filled]
+
     except sqlite3.Error as e:
         logging.error(f"Gagal memuat embedding: {e}")
-    finally:
-        if conn:
-            conn.close()
+        ids, names = [], []
+        matrix = np.empty((0, EMBEDDING_DIM), dtype=np.float32)
     
-    return magang_list
+    return matrix, ids, names
 
 def check_already_absen(db_name: str, magang_id: str, log_type: str = 'MASUK') -> bool:
     """
     Memeriksa apakah magang sudah absen (MASUK) hari ini.
     """
-    conn = None
     try:
         # Gunakan hari ini (tanpa jam) sebagai batas bawah
         today_start = date.today().strftime('%Y-%m-%d 00:00:00')
         
-        conn = sqlite3.connect(db_name)
+        conn = _get_conn(db_name)
         cursor = conn.cursor()
         
         # Cari log absensi hari ini dengan tipe MASUK
@@ -154,32 +237,48 @@ def check_already_absen(db_name: str, magang_id: str, log_type: str = 'MASUK') -
         logging.error(f"Gagal memeriksa status absensi: {e}")
         return False
 
-    finally:
-        if conn:
-            conn.close()
+def update_absensi_log(db_name: str, magang_id: str, magang_name: str, log_time: Optional[str] = None, log_type: str = 'MASUK') -> bool:
+    """
+    Mencatat absensi berhasil ke tabel absensi (maksimal satu log per tipe per hari).
+    Jika log_time None, waktu (lokal) diisi langsung oleh SQLite.
+    Sama dengan try_log_absensi; dipertahankan untuk kompatibilitas pemanggil lama.
+    """
+    return try_log_absensi(db_name, magang_id, magang_name, log_time, log_type)
 
-def update_absensi_log(db_name: str, magang_id: str, magang_name: str, log_time: str, log_type: str = 'MASUK'):
+def try_log_absensi(db_name: str, magang_id: str, magang_name: str, log_time: Optional[str] = None, log_type: str = 'MASUK') -> bool:
     """
-    Mencatat absensi berhasil ke tabel absensi menggunakan waktu eksplisit dari server.
+    Mencatat absensi hanya jika magang belum absen (tipe yang sama) pada hari itu.
+    Jika log_time None, waktu (lokal) diisi langsung oleh SQLite.
+    Pengecekan dan penulisan dilakukan dalam satu statement (INSERT ... WHERE NOT EXISTS)
+    yang memakai index 'idx_absensi_lookup'.
+    Mengembalikan True jika log baru dicatat, False jika sudah ada atau gagal.
     """
-    conn = None
+    conn = _get_conn(db_name)
     try:
-        conn = sqlite3.connect(db_name)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            INSERT INTO absensi (magang_id, nama, timestamp, type)
-            VALUES (?, ?, ?, ?)
-        """, (magang_id, magang_name, log_time, log_type))
+        with _WRITE_LOCK:
+            cursor = conn.execute("""
+                INSERT INTO absensi (magang_id, nama, timestamp, type)
+                SELECT ?, ?, t.ts, ?
+                FROM (SELECT COALESCE(?, datetime('now', 'localtime')) AS ts) AS t
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM absensi
+                    WHERE magang_id = ? AND type = ?
+                      AND timestamp >= date(t.ts) AND timestamp < date(t.ts, '+1 day')
+                )
+            """, (magang_id, magang_name, log_type, log_time, magang_id, log_type))
+            conn.commit()
+            inserted = cursor.rowcount == 1
 
-        conn.commit()
-        logging.info(f"Log absensi '{log_type}' untuk {magang_name} berhasil dicatat pada {log_time}.")
+        if inserted:
+            logging.info(f"Log absensi '{log_type}' untuk {magang_name} berhasil dicatat pada {log_time or 'waktu saat ini'}.")
+        else:
+            logging.info(f"{magang_name} sudah tercatat absen '{log_type}' hari ini.")
+        return inserted
 
     except sqlite3.Error as e:
+        conn.rollback()
         logging.error(f"Gagal mencatat log absensi: {e}")
-    finally:
-        if conn:
-            conn.close()
+        return False
 
 if __name__ == "__main__":
-    logging.warning("Modul persistence ini biasanya di-import, bukan dijalankan langsung.")
\ No newline at end of file
+    logging.warning("Modul persistence ini biasanya di-import, bukan dijalankan langsung.")
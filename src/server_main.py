@@ -1,16 +1,18 @@
 import os
 import sys
 import time
-import io
+import hashlib
 import json
 import numpy as np
 import torch
 import logging
+from collections import OrderedDict
+from itertools import islice
 from facenet_pytorch import MTCNN, InceptionResnetV1
 from PIL import Image
 
-from fastapi import FastAPI, File, UploadFile, status, HTTPException
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi import FastAPI, File, UploadFile, BackgroundTasks, status, HTTPException
+from fastapi.responses import JSONResponse, FileResponse
 from gtts import gTTS # Digunakan untuk simulasi audio
 import httpx # Digunakan untuk API calls (jika diperlukan)
 
@@ -26,66 +28,113 @@ DATABASE_NAME = 'absensi.db'
 app = FastAPI(title="Absensi Magang Telkomsat AI Server")
 SIMILARITY_THRESHOLD = 0.95  # Cosine Distance: semakin kecil angkanya semakin mirip (0 = sempurna)
 tts_output_folder = "audio_responses"
+_PENDING_TTS = set()  # Path audio yang sedang dibuat oleh background task
 
 resnet = None
 mtcnn = None
-MAGANG_EMBEDDINGS = []
+device = torch.device('cpu')
+resnet_dtype = torch.float32  # float16 jika berjalan di CUDA
+# Khusus CUDA: buffer input FaceNet (1, 3, 160, 160) yang dipakai ulang setiap request,
+# diisi dari buffer host pinned agar transfer H2D bisa non-blocking
+resnet_input = None
+resnet_pinned = None
+# Matriks (N, 512) float32 dengan baris ter-normalisasi (L2),
+# plus array ID/nama yang sejajar barisnya
+MAGANG_MATRIX = np.empty((0, db.EMBEDDING_DIM), dtype=np.float32)
+MAGANG_IDS = []
+MAGANG_NAMES = []
+# Magang yang terakhir dikenali (ID -> index baris), paling baru di akhir
+MAGANG_LRU = OrderedDict()
+LRU_PROBE_SIZE = 8  # Jumlah magang terbaru yang dicek sebelum memindai semua baris
+EARLY_EXIT_DISTANCE = 0.05  # Jauh di bawah SIMILARITY_THRESHOLD: dianggap pasti cocok
 
 # --- HELPER FUNCTIONS ---
 
-def calculate_cosine_distance(emb1: np.ndarray, emb2: np.ndarray) -> float:
-    """Menghitung Cosine Distance (1 - Cosine Similarity). Jarak terdekat = 0."""
-    dot_product = np.dot(emb1.flatten(), emb2.flatten())
-    norm_emb1 = np.linalg.norm(emb1)
-    norm_emb2 = np.linalg.norm(emb2)
-    
-    if norm_emb1 == 0 or norm_emb2 == 0:
-        return 1.0 
+def _probe_recent(v: np.ndarray):
+    """
+    Mengecek magang yang baru saja dikenali lebih dulu (lokalitas temporal: orang yang sama
+    sering mencoba beberapa kali). Mengembalikan (index, distance) jika ada yang cocok
+    di bawah EARLY_EXIT_DISTANCE, selain itu None.
+    """
+    if not MAGANG_LRU:
+        return None
 
-    cosine_similarity = dot_product / (norm_emb1 * norm_emb2)
-    return 1 - cosine_similarity
+    recent = np.fromiter(islice(reversed(MAGANG_LRU.values()), LRU_PROBE_SIZE), dtype=np.intp)
+    sims = MAGANG_MATRIX[recent] @ v
+    k = int(np.argmax(sims))
+    distance = 1.0 - float(sims[k])
+    if distance < EARLY_EXIT_DISTANCE:
+        return int(recent[k]), distance
+    return None
 
 def recognize_face(live_embedding: np.ndarray):
-    """Mengidentifikasi wajah dengan Cosine Distance terendah."""
-    if not MAGANG_EMBEDDINGS:
+    """Mengidentifikasi wajah dengan Cosine Distance terendah (satu perkalian matriks-vektor)."""
+    if MAGANG_MATRIX.shape[0] == 0:
         return "UNKNOWN", 999.0, "UNKNOWN"
 
-    min_distance = float('inf')
-    best_match_id = "UNKNOWN"
-    best_match_name = "UNKNOWN"
+    v = live_embedding.ravel().astype(np.float32)
+    # Hanya live embedding yang perlu dinormalisasi (np.vdot lebih ringan dari np.linalg.norm)
+    norm_sq = np.vdot(v, v)
+    if norm_sq == 0:
+        return "UNKNOWN", 1.0, "UNKNOWN"
+    v /= np.sqrt(norm_sq)
 
-    for magang in MAGANG_EMBEDDINGS:
-        master_embedding = magang['embedding'].flatten()
-        distance = calculate_cosine_distance(live_embedding, master_embedding)
-        
-        if distance < min_distance:
-            min_distance = distance
-            best_match_id = magang['id']
-            best_match_name = magang['name']
+    # Cek magang terbaru dulu, pindai semua baris hanya jika perlu
+    recent_match = _probe_recent(v) if MAGANG_MATRIX.shape[0] > LRU_PROBE_SIZE else None
+    if recent_match is not None:
+        best_idx, min_distance = recent_match
+    else:
+        # Cosine Similarity terhadap semua magang sekaligus (GEMV float32)
+        sims = MAGANG_MATRIX @ v
+        best_idx = int(np.argmax(sims))
+        min_distance = 1.0 - float(sims[best_idx])
 
     if min_distance > SIMILARITY_THRESHOLD:
         return "UNKNOWN", min_distance, "UNKNOWN"
     else:
-        return best_match_id, min_distance, best_match_name
+        best_match_id = MAGANG_IDS[best_idx]
+        MAGANG_LRU[best_match_id] = best_idx
+        MAGANG_LRU.move_to_end(best_match_id)
+        return best_match_id, min_distance, MAGANG_NAMES[best_idx]
 
-def generate_audio(text_message: str, magang_id: str) -> str:
-    """Membuat file audio MP3 (TTS) dari pesan."""
+def _synthesize_tts(text_message: str, audio_path: str):
+    """Membuat file audio MP3 (TTS) dengan gTTS. Dijalankan sebagai background task."""
+    tmp_path = f"{audio_path}.tmp"
     try:
-        audio_filename = f"response_audio_{magang_id}_{int(time.time())}.mp3"
-        audio_path = os.path.join(tts_output_folder, audio_filename)
-        
         os.makedirs(tts_output_folder, exist_ok=True)
         
         # Menggunakan gTTS untuk membuat audio MP3
         tts = gTTS(text=text_message, lang='id')
-        tts.save(audio_path)
-        
-        # Mengembalikan URL relatif
-        return f"/audio/{audio_filename}"
+        tts.save(tmp_path)
+        # Rename atomik agar Klien tidak pernah menerima file yang belum selesai ditulis
+        os.replace(tmp_path, audio_path)
         
     except Exception as e:
-        logging.error(f"Gagal membuat audio TTS: {e}")
-        return ""
+        # File tidak dibuat, sehingga request berikutnya dengan pesan yang sama akan mencoba lagi
+        logging.error(f"Gagal membuat audio TTS ({os.path.basename(audio_path)}), dicoba lagi pada request berikutnya: {e}")
+    finally:
+        _PENDING_TTS.discard(audio_path)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def generate_audio(text_message: str, background_tasks: BackgroundTasks) -> str:
+    """
+    Mengembalikan URL audio untuk pesan secara langsung.
+    Nama file ditentukan oleh hash pesan, sehingga pesan yang sama memakai ulang MP3 yang sudah ada;
+    jika belum ada, file dibuat di background setelah respons dikirim.
+    Jika pembuatan di background gagal, URL yang dikembalikan tidak akan tersedia (404); kegagalan
+    dicatat di log dan file akan dibuat ulang pada request berikutnya dengan pesan yang sama.
+    """
+    audio_key = hashlib.sha1(text_message.encode('utf-8')).hexdigest()
+    audio_filename = f"{audio_key}.mp3"
+    audio_path = os.path.join(tts_output_folder, audio_filename)
+
+    if not os.path.exists(audio_path) and audio_path not in _PENDING_TTS:
+        _PENDING_TTS.add(audio_path)
+        background_tasks.add_task(_synthesize_tts, text_message, audio_path)
+
+    # Mengembalikan URL relatif
+    return f"/audio/{audio_filename}"
 
 
 # --- LIFECYCLE HOOKS ---
@@ -93,7 +142,7 @@ def generate_audio(text_message: str, magang_id: str) -> str:
 @app.on_event("startup")
 async def startup_event():
     """Memuat model AI dan data master saat Server dimulai."""
-    global resnet, mtcnn, MAGANG_EMBEDDINGS
+    global resnet, mtcnn, device, resnet_dtype, resnet_input, resnet_pinned, MAGANG_MATRIX, MAGANG_IDS, MAGANG_NAMES
     
     logging.info("Memulai Server. Memuat Model AI (MTCNN & FaceNet) dan Data Master...")
     
@@ -107,14 +156,33 @@ async def startup_event():
         thresholds=[0.6, 0.7, 0.7], factor=0.709, post_process=True, device=device
     )
     resnet = InceptionResnetV1(pretrained='vggface2').eval().to(device)
+    if device.type == 'cuda':
+        # Half precision + torch.compile (CUDA graphs) untuk forward pass tunggal per request
+        resnet = resnet.half()
+        resnet_dtype = torch.float16
+        resnet = torch.compile(resnet, mode='reduce-overhead')
+
+        resnet_input = torch.empty((1, 3, 160, 160), device=device, dtype=resnet_dtype)
+        resnet_pinned = torch.empty_like(resnet_input, device='cpu').pin_memory()
+
+        # torch.compile bersifat lazy: kompilasi & capture CUDA graph dipicu di sini (beberapa
+        # forward pass), bukan di request /absensi pertama yang akan memblokir event loop
+        resnet_input.zero_()
+        with torch.inference_mode():
+            for _ in range(3):
+                resnet(resnet_input)
+        torch.cuda.synchronize(device)
+        logging.info("Model FaceNet (torch.compile) siap.")
 
-    # 3. Muat Data Master Embedding dari DB
-    MAGANG_EMBEDDINGS = db.load_all_magang_embeddings(DATABASE_NAME)
+    # 3. Pastikan tabel & index terbaru ada, lalu muat Data Master Embedding dari DB
+    db.create_initial_tables(DATABASE_NAME)
+    MAGANG_MATRIX, MAGANG_IDS, MAGANG_NAMES = db.load_all_magang_embeddings(DATABASE_NAME)
+    MAGANG_LRU.clear()
     
-    if not MAGANG_EMBEDDINGS:
+    if not MAGANG_IDS:
         logging.warning("Database Master Magang KOSONG. Jalankan 02_training_embedding.py!")
     
-    logging.info(f"Inisialisasi Selesai. Total {len(MAGANG_EMBEDDINGS)} data magang dimuat.")
+    logging.info(f"Inisialisasi Selesai. Total {len(MAGANG_IDS)} data magang dimuat.")
 
 @app.on_event("shutdown")
 def shutdown_event():
@@ -131,22 +199,25 @@ def shutdown_event():
 # --- ENDPOINT FASTAPI ---
 
 @app.post("/absensi")
-async def absensi_endpoint(file: UploadFile = File(...)):
+async def absensi_endpoint(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
     """
     Menerima gambar full frame dari Klien ESP32, memprosesnya, dan memberikan respons audio.
     """
     start_time = time.time()
     
     try:
-        image_bytes = await file.read()
-        img = Image.open(io.BytesIO(image_bytes))
+        # Baca langsung dari file upload (tanpa salinan BytesIO); untuk JPEG, draft() membuat
+        # libjpeg men-decode pada skala yang lebih kecil (tetap >= 640x480, cukup untuk MTCNN)
+        img = Image.open(file.file)
+        img.draft('RGB', (640, 480))
+        img.load()
         
         # 2. Deteksi dan Ekstraksi Wajah (MTCNN)
         face_tensor = mtcnn(img) 
         
         if face_tensor is None:
             message = "Maaf, wajah tidak terdeteksi dengan jelas. Coba lagi."
-            audio_url = generate_audio(message, "no_face")
+            audio_url = generate_audio(message, background_tasks)
             return JSONResponse(status_code=400, content={
                 "status": "FAIL", "message": message,
                 "audio_url": audio_url,
@@ -154,32 +225,44 @@ async def absensi_endpoint(file: UploadFile = File(...)):
             })
         
         # 3. Ekstraksi Live Embedding (FaceNet)
-        with torch.no_grad():
-            live_embedding = resnet(face_tensor.unsqueeze(0)).cpu().detach().numpy()
+        if resnet_input is not None:
+            resnet_pinned.copy_(face_tensor.unsqueeze(0))
+            resnet_input.copy_(resnet_pinned, non_blocking=True)
+            model_input = resnet_input
+        else:
+            # CPU: tensor MTCNN sudah berada di device & dtype yang benar
+            model_input = face_tensor.unsqueeze(0)
+        with torch.inference_mode():
+            live_embedding = resnet(model_input).float().cpu().numpy()
             
         # 4. Pengenalan Wajah dan Keputusan Log
         id_magang, distance, nama = recognize_face(live_embedding)
 
         if id_magang != "UNKNOWN":
-            # Wajah Dikenali
-            db.update_absensi_log(DATABASE_NAME, id_magang, nama)
+            # Wajah Dikenali: cek & catat log dalam satu query
+            is_new_log = db.try_log_absensi(DATABASE_NAME, id_magang, nama)
             
-            message = f"Absensi masuk berhasil, selamat bekerja {nama}."
-            audio_url = generate_audio(message, id_magang)
+            if is_new_log:
+                message = f"Absensi masuk berhasil, selamat bekerja {nama}."
+            else:
+                message = f"{nama}, Anda sudah absen masuk hari ini."
+            audio_url = generate_audio(message, background_tasks)
             
             logging.info(f"✅ ABSENSI BERHASIL: {nama} (Dist: {distance:.4f})")
             
             return JSONResponse(status_code=200, content={
                 "status": "SUCCESS", "message": message,
                 "magang_id": id_magang,
+                "already_absen": not is_new_log,
                 "distance": f"{distance:.4f}",
                 "audio_url": audio_url,
                 "processing_time": f"{time.time() - start_time:.2f}s"
             })
         else:
             # Wajah TIDAK Dikenali
-            message = f"Maaf, wajah tidak dikenali. Jarak terdekat: {distance:.2f}. Silakan coba lagi."
-            audio_url = generate_audio(message, "unknown")
+            # Pesan tetap (tanpa jarak) agar audio-nya bisa di-cache; jarak hanya dikirim di JSON
+            message = "Maaf, wajah tidak dikenali. Silakan coba lagi."
+            audio_url = generate_audio(message, background_tasks)
             
             logging.warning(f"❌ ABSENSI GAGAL: Tidak Dikenal (Dist: {distance:.4f})")
 
@@ -193,10 +276,11 @@ async def absensi_endpoint(file: UploadFile = File(...)):
     except Exception as e:
         error_msg = f"Error Server Internal: {e}"
         logging.error(error_msg, exc_info=True)
-        # TTS Fallback
-        audio_url = generate_audio("Terjadi kesalahan di server. Silakan coba lagi.", "server_error")
         raise HTTPException(status_code=500, detail=error_msg)
 
+    finally:
+        await file.close()
+
 # --- ENDPOINT UNTUK AUDIO (Diakses oleh Klien ESP32) ---
 
 @app.get("/audio/{filename}")
@@ -207,11 +291,12 @@ async def get_audio_file(filename: str):
     if not os.path.exists(file_path):
         raise HTTPException(status_code=404, detail="File audio tidak ditemukan.")
 
-    def file_iterator():
-        with open(file_path, mode="rb") as f:
-            yield from f
-    
-    return StreamingResponse(file_iterator(), media_type="audio/mp3")
+    # FileResponse mengirim file via sendfile (tanpa salinan di user-space).
+    # Nama file = hash pesan, jadi isinya tidak pernah berubah dan aman di-cache Klien.
+    return FileResponse(
+        file_path, media_type="audio/mp3", filename=filename,
+        headers={"Cache-Control": "public, max-age=86400"}
+    )
 
 @app.get("/")
 async def root():
@@ -7,6 +7,9 @@ import sys
 import numpy as np
 import torch
 import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from facenet_pytorch import MTCNN, InceptionResnetV1
 from PIL import Image
 import logging
@@ -21,6 +24,15 @@ except ImportError:
     import _data_persistance as db
 
 
+# Opsional: libjpeg-turbo (PyTurboJPEG) untuk decode JPEG yang lebih cepat (SIMD)
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    _TURBOJPEG = TurboJPEG()
+except Exception:
+    # Library tidak terpasang / libturbojpeg tidak ditemukan -> pakai Pillow
+    _TURBOJPEG = None
+
+
 # Konfigurasi Logging
 logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
 
@@ -29,26 +41,80 @@ DATABASE_NAME = 'absensi.db'
 # Gunakan os.path.join untuk keamanan path
 DATABASE_PATH = os.path.join("database", DATABASE_NAME) 
 DATA_ROOT = 'data_master/dataset' # Folder utama dataset
-BATCH_SIZE = 32 # Jumlah gambar yang diproses bersamaan
+BATCH_SIZE = 128 # Jumlah gambar yang diproses bersamaan (lintas semua magang)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
 
 def get_magang_folders(root_dir):
     """
     Menemukan semua folder Magang (level 3) dalam struktur bertingkat 
-    (data_master/dataset/Institusi/Nama Individu).
+    (data_master/dataset/Institusi/Nama Individu) beserta daftar file gambarnya,
+    dalam satu kali penelusuran os.scandir.
     """
-    magang_data = [] # List of {'name': 'Said', 'path': '.../Said'}
-    
-    # os.walk akan menelusuri folder secara rekursif
-    for root, dirs, files in os.walk(root_dir):
+    magang_data = [] # List of {'id': 'Said', 'name': 'Said', 'path': '.../Said', 'files': [...]}
+
+    def _scan(folder_path):
+        image_files = []
+        with os.scandir(folder_path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    _scan(entry.path)
+                elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                    image_files.append(entry.path)
+
         # Kita hanya tertarik pada folder yang berisi file gambar (individu magang)
-        if any(f.lower().endswith(('.jpg', '.jpeg', '.png')) for f in files):
+        if image_files:
             # Nama folder individu adalah nama magang
-            magang_name = os.path.basename(root)
+            magang_name = os.path.basename(folder_path)
             # Menggunakan ID yang lebih spesifik jika diperlukan, saat ini ID=Nama
-            magang_data.append({'id': magang_name, 'name': magang_name, 'path': root}) 
+            magang_data.append({'id': magang_name, 'name': magang_name, 'path': folder_path, 'files': image_files})
 
+    _scan(root_dir)
     return magang_data
 
+def _load_image(path):
+    """
+    Membuka gambar dan mengonversinya ke RGB (dijalankan di thread pool).
+    Mengembalikan None jika gambar rusak/tidak bisa dibaca, agar hanya gambar itu yang dilewati.
+    """
+    try:
+        if _TURBOJPEG is not None and path.lower().endswith(('.jpg', '.jpeg')):
+            with open(path, 'rb') as f:
+                return Image.fromarray(_TURBOJPEG.decode(f.read(), pixel_format=TJPF_RGB))
+
+        with Image.open(path) as img:
+            return img.convert('RGB')
+    except Exception as e:
+        logging.error(f"Gagal membuka gambar {path}: {e}. Skip gambar.")
+        return None
+
+def _prefetch_batches(all_items, executor):
+    """
+    Generator batch (index awal, items, gambar) dengan double-buffering:
+    thread produsen men-decode batch berikutnya selagi batch saat ini diproses MTCNN/FaceNet.
+    Gambar yang gagal di-decode dibuang beserta item-nya, sehingga items dan gambar tetap sejajar.
+    """
+    batch_queue = queue.Queue(maxsize=2)
+    done = object()
+
+    def producer():
+        try:
+            for i in range(0, len(all_items), BATCH_SIZE):
+                batch_items = all_items[i:i + BATCH_SIZE]
+                decoded = executor.map(_load_image, [path for _, path in batch_items])
+                valid = [(item, img) for item, img in zip(batch_items, decoded) if img is not None]
+                batch_queue.put((i, [item for item, _ in valid], [img for _, img in valid]))
+        finally:
+            batch_queue.put(done)
+
+    threading.Thread(target=producer, daemon=True).start()
+
+    while True:
+        batch = batch_queue.get()
+        if batch is done:
+            return
+        yield batch
+
 def process_and_save_embeddings():
     """
     Memuat model, memproses dataset, menghitung embedding, dan menyimpan ke DB.
@@ -82,65 +148,90 @@ def process_and_save_embeddings():
     if not os.path.exists(os.path.dirname(DATABASE_PATH)):
         os.makedirs(os.path.dirname(DATABASE_PATH))
 
-    # Bersihkan tabel master wajah
+    # Pastikan tabel sudah ada, lalu bersihkan tabel master wajah
+    db.create_initial_tables(DATABASE_PATH)
     db.clear_magang_table(DATABASE_PATH)
     logging.info(f"Database magang lama dibersihkan.")
     
-    total_wajah_diproses = 0
+    # Kumpulkan SEMUA gambar dari semua magang: (index magang, path gambar)
+    all_items = []
+    for magang_idx, magang in enumerate(magang_list):
+        all_items.extend((magang_idx, f) for f in magang['files'])
+
+    logging.info(f"Total {len(all_items)} gambar dari {len(magang_list)} magang akan diproses.")
+
+    # Akumulator embedding per magang (rata-rata dihitung setelah semua batch selesai)
+    sum_per_magang = np.zeros((len(magang_list), 512), dtype=np.float64)
+    count_per_magang = np.zeros(len(magang_list), dtype=np.int64)
+    use_cuda = device.type == 'cuda'
+    total_batch = (len(all_items) + BATCH_SIZE - 1) // BATCH_SIZE
+
+    # Decode gambar (melepas GIL) dikerjakan paralel di thread pool dan di-prefetch satu batch ke depan
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for i, batch_items, batch_images in _prefetch_batches(all_items, executor):
+            batch_no = i // BATCH_SIZE + 1
 
-    for magang in magang_list:
-        magang_id = magang['id']
-        magang_name = magang['name']
-        folder_path = magang['path']
-        
-        logging.info(f"\n--- Memproses Magang: {magang_name} ---")
-        
-        image_files = [os.path.join(folder_path, f) for f in os.listdir(folder_path) if f.lower().endswith(('.jpg', '.jpeg', '.png'))]
-        if not image_files:
-            logging.error(f"Tidak ada gambar ditemukan di {folder_path}. Skip.")
-            continue
-            
-        embeddings = []
-        for i in range(0, len(image_files), BATCH_SIZE):
-            batch_files = image_files[i:i + BATCH_SIZE]
-            batch_images = [Image.open(f).convert('RGB') for f in batch_files]
-            
             try:
-                # MTCNN mendeteksi dan melakukan preprocessing
-                faces = mtcnn(batch_images) 
-                # Filter None values (wajah yang gagal dideteksi)
-                faces = [f for f in faces if f is not None] 
+                # MTCNN hanya bisa batch untuk gambar berukuran sama, jadi kelompokkan per ukuran
+                groups = {}
+                for k, img in enumerate(batch_images):
+                    groups.setdefault(img.size, []).append(k)
+
+                faces, face_owner = [], []
+                for positions in groups.values():
+                    detected = mtcnn([batch_images[k] for k in positions])
+                    for k, face in zip(positions, detected):
+                        # Lewati wajah yang gagal dideteksi (None)
+                        if face is not None:
+                            faces.append(face)
+                            face_owner.append(batch_items[k][0])
 
                 if not faces:
-                    logging.warning(f"Wajah tidak terdeteksi di batch {i//BATCH_SIZE + 1}. Skip.")
+                    logging.warning(f"Wajah tidak terdeteksi di batch {batch_no}/{total_batch}. Skip.")
                     continue
-                
+
                 # Stack faces menjadi satu tensor dan pindahkan ke device
-                face_tensor = torch.stack(faces).to(device)
-                
-                # InceptionResnetV1 menghitung embedding
-                with torch.no_grad():
-                    batch_embeddings = resnet(face_tensor).detach().cpu().numpy()
-                
-                embeddings.extend(batch_embeddings)
-                
-                logging.info(f"Batch {i//BATCH_SIZE + 1} diproses. {len(faces)} wajah di-'embed'.")
+                face_tensor = torch.stack(faces)
+                if use_cuda:
+                    face_tensor = face_tensor.pin_memory()
+                face_tensor = face_tensor.to(device, non_blocking=True)
+
+                # InceptionResnetV1 menghitung embedding (fp16 autocast di GPU)
+                with torch.inference_mode(), torch.autocast(device_type=device.type, dtype=torch.float16, enabled=use_cuda):
+                    batch_embeddings = resnet(face_tensor).float().cpu().numpy()
+
+                # Scatter embedding kembali ke magang pemiliknya
+                np.add.at(sum_per_magang, face_owner, batch_embeddings)
+                np.add.at(count_per_magang, face_owner, 1)
+
+                logging.info(f"Batch {batch_no}/{total_batch} diproses. {len(faces)} wajah di-'embed'.")
 
             except Exception as e:
-                logging.error(f"ERROR saat memproses batch: {e}. Skip batch.")
-                continue 
+                logging.error(f"ERROR saat memproses batch {batch_no}: {e}. Skip batch.")
+                continue
 
-        if not embeddings:
+    total_wajah_diproses = 0
+    rows_to_save = [] # Ditulis ke DB sekaligus setelah loop (satu transaksi)
+
+    for magang_idx, magang in enumerate(magang_list):
+        magang_name = magang['name']
+        count = int(count_per_magang[magang_idx])
+
+        if count == 0:
             logging.error(f"Gagal membuat embedding untuk {magang_name}. Tidak ada wajah valid terdeteksi.")
             continue
-            
+
         # Hitung rata-rata embedding dari semua gambar yang valid
-        avg_embedding = np.mean(embeddings, axis=0)
-        total_wajah_diproses += len(embeddings)
-        
-        # Simpan ke DB
-        status, message = db.save_new_magang(DATABASE_PATH, magang_id, magang_name, avg_embedding)
-        logging.info(f"Status DB: {status}. Master Embedding tersimpan.")
+        avg_embedding = (sum_per_magang[magang_idx] / count).astype(np.float32)
+        total_wajah_diproses += count
+        logging.info(f"{magang_name}: {count} wajah valid.")
+
+        rows_to_save.append((magang['id'], magang_name, avg_embedding))
+
+    # Simpan semua master embedding ke DB dalam satu transaksi
+    if rows_to_save:
+        status, message = db.save_many_magang(DATABASE_PATH, rows_to_save)
+        logging.info(f"Status DB: {status}. {message}")
 
     logging.info(f"\n--- RINGKASAN TRAINING ---")
     if total_wajah_diproses > 0: